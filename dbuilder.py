@@ -21,6 +21,9 @@ import subprocess
 import glob
 import tarfile
 import re
+import hashlib
+import errno
+import stat
 
 ######################################################################
 # Default configuration parameters and match lists.
@@ -191,6 +194,51 @@ def dst_path(path, src_dir, dst_dir):
     dst_dir = os.path.abspath(dst_dir)
     return dst_dir + path[len(src_dir):]
 
+def file_digest(filename):
+    """
+    Return SHA-1 hex digest of the contents of filename.
+    """
+    h = hashlib.sha1()
+    f = open(filename, 'rb')
+    try:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            h.update(data)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+def find_duplicates(filenames):
+    """
+    Return a list of groups of byte-identical files with the same permission
+    bits from the 'filenames' list. Each group is a list of two or more file
+    names in 'filenames' order.
+
+    Files are first grouped by size and mode so only files sharing both with
+    some other file are read and digested. Empty files are ignored.
+
+    """
+    stats = {}      # (size, mode) keyed by file name.
+    counts = {}     # Number of files keyed by (size, mode).
+    for filename in filenames:
+        st = os.stat(filename)
+        if st.st_size > 0:
+            stats[filename] = (st.st_size, stat.S_IMODE(st.st_mode))
+            counts[stats[filename]] = counts.get(stats[filename], 0) + 1
+    digests = {}    # Files keyed by (size, mode, digest).
+    keys = []       # Digest keys in order of first occurrence.
+    for filename in filenames:
+        if counts.get(stats.get(filename), 0) < 2:
+            continue
+        key = stats[filename] + (file_digest(filename),)
+        if key not in digests:
+            digests[key] = []
+            keys.append(key)
+        digests[key].append(filename)
+    return [digests[key] for key in keys if len(digests[key]) > 1]
+
 
 ###########
 # Helpers #
@@ -198,6 +246,19 @@ def dst_path(path, src_dir, dst_dir):
 
 # For use by pre_build and post_build conf file functions.
 
+def unlink_file(filename):
+    """
+    Delete filename if it exists.
+    Call before writing to an existing distribution file: files hardlinked by
+    the --link-duplicates option share their contents and writing to one
+    changes every linked copy.
+    Honors --dry-run and --verbose command-line options.
+    """
+    if os.path.isfile(filename):
+        verbose('rm %s' % filename)
+        if not OPTIONS.dry_run:
+            os.remove(filename)
+
 def expand_path(filename, default_dir):
     """
     Return expanded file path.
@@ -247,6 +308,7 @@ def copy_dist_files(src, dst):
                 os.makedirs(dst)
         for f in filenames:
             g = os.path.join(dst, os.path.basename(f))
+            unlink_file(g)
             verbose('cp %s %s' % (f, g))
             if not OPTIONS.dry_run:
                 shutil.copyfile(f, g)
@@ -257,6 +319,7 @@ def copy_dist_files(src, dst):
             verbose('mkdir -p %s' % dst_dir)
             if not OPTIONS.dry_run:
                 os.makedirs(dst_dir)
+        unlink_file(dst)
         verbose('cp %s %s' % (src, dst))
         if not OPTIONS.dry_run:
             shutil.copyfile(src, dst)
@@ -350,6 +413,54 @@ def copy_dist(src_dir,
                         if not OPTIONS.dry_run:
                             os.remove(filename)
 
+def link_duplicates(dist_dir):
+    """
+    Replace duplicate files in the distribution directory with hardlinks to
+    the first copy. The MANIFEST file is never linked.
+    Returns the number of bytes saved by links made in this pass.
+    """
+    manifest = Manifest(dist_dir)
+    if not hasattr(os, 'link'):
+        infomsg('hardlinks not supported: skipping duplicate files in %s'
+                % manifest.dist_dir)
+        return 0
+    infomsg('linking duplicate files in %s' % manifest.dist_dir)
+    filenames = [os.path.join(manifest.dist_dir, f)
+                 for f in manifest.dist_files()]
+    filenames = [f for f in filenames if f != manifest.manifest_file]
+    saved = 0
+    linked = 0      # Bytes saved by files linked on a previous run.
+    for group in find_duplicates(filenames):
+        src = group[0]
+        for dst in group[1:]:
+            size = os.path.getsize(src)
+            if os.path.samefile(src, dst):
+                linked += size
+                continue
+            verbose('ln -f %s %s' % (src, dst))
+            if not OPTIONS.dry_run:
+                # Link to an unused temporary name then rename so dst is
+                # never lost and no existing file is overwritten.
+                n = 0
+                while True:
+                    tmp = '%s.%d.tmp' % (dst, n)
+                    try:
+                        os.link(src, tmp)
+                        break
+                    except OSError, e:
+                        if e.errno != errno.EEXIST:
+                            raise
+                        n += 1
+                try:
+                    os.rename(tmp, dst)
+                except OSError:
+                    os.remove(tmp)
+                    raise
+            saved += size
+    infomsg('duplicate files: %d bytes saved (%d bytes already linked)'
+            % (saved, linked))
+    return saved
+
 class Manifest(object):
     """
     Read/write/compare MANIFEST file with distribution files.
@@ -478,6 +589,8 @@ def make_tarball(filename):
     """
     Make a tarball containing files in the distribution directory.
     The stored file root directory is the filename base.
+    If the --link-duplicates command-line option is set duplicate files with
+    the same permissions are stored as hardlinks to the first copy.
     """
     # Strip directory name and tarball extensions from file name.
     basename = os.path.basename(filename)
@@ -488,6 +601,18 @@ def make_tarball(filename):
         dist_files.remove('MANIFEST')
     except ValueError:
         pass
+    # Map duplicate files to the first archived copy.
+    links = {}
+    if OPTIONS.link_duplicates:
+        names = dict([(os.path.join(OPTIONS.dist_dir, f), f)
+                      for f in dist_files])
+        saved = 0
+        for group in find_duplicates(
+                [os.path.join(OPTIONS.dist_dir, f) for f in dist_files]):
+            for name in group[1:]:
+                links[names[name]] = names[group[0]]
+                saved += os.path.getsize(name)
+        infomsg('tarball duplicate files: %d bytes saved' % saved)
     infomsg('creating tarball: %s' % filename)
     if not OPTIONS.dry_run:
         if filename.endswith('.bz2'):
@@ -498,14 +623,24 @@ def make_tarball(filename):
     for distfile in dist_files:
         name = os.path.join(OPTIONS.dist_dir, distfile)
         arname = '%s/%s' % (basename, distfile)
-        verbose('archiving: %s' % arname)
+        if distfile in links:
+            linkname = '%s/%s' % (basename, links[distfile])
+            verbose('archiving: %s -> %s' % (arname, linkname))
+        else:
+            verbose('archiving: %s' % arname)
         if not OPTIONS.dry_run:
             tarinfo = tar.gettarinfo(name, arname)
             tarinfo.uid = 0
             tarinfo.gid = 0
             tarinfo.uname = 'root'
             tarinfo.gname = 'root'
-            tar.addfile(tarinfo, file(name, 'rb'))
+            if distfile in links:
+                tarinfo.type = tarfile.LNKTYPE
+                tarinfo.linkname = linkname
+                tarinfo.size = 0
+                tar.addfile(tarinfo)
+            else:
+                tar.addfile(tarinfo, file(name, 'rb'))
     if not OPTIONS.dry_run:
         tar.close()
 
@@ -543,6 +678,9 @@ Django runtime written to 'DIST_DIR/%s'.""" % \
     parser.add_option('-t', '--tarball',
         dest='tarball', default=None, metavar='TARBALL_FILE',
         help='create TARBALL_FILE of distribution directory')
+    parser.add_option('-l', '--link-duplicates',
+        action='store_true', dest='link_duplicates', default=False,
+        help='hardlink duplicate distribution and tarball files')
     parser.add_option('-m', '--manifest',
         action='store_true', dest='manifest', default=False,
         help='write MANIFEST file and exit')
@@ -639,6 +777,8 @@ Django runtime written to 'DIST_DIR/%s'.""" % \
         build_python_runtime()
     infomsg('executing post_build')
     post_build()
+    if OPTIONS.link_duplicates:
+        link_duplicates(OPTIONS.dist_dir)
     if os.path.isfile(manifest.manifest_file):
         if OPTIONS.dry_run:
             infomsg('dry run: skipping manifest comparision')